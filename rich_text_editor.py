@@ -1,9 +1,28 @@
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Pango, Gdk
+from gi.repository import Gtk, Pango, Gdk, GLib
 import os
 import struct
 
+# Session snapshot, written on quit and periodically while the editor runs
+SESSION_FILE = os.path.join(GLib.get_user_cache_dir(), 'rich-text-editor', 'session.bin')
+SESSION_MAGIC = b'RTES'
+SESSION_VERSION = 1
+SESSION_SAVE_INTERVAL = 30  # seconds
+SESSION_RESTORE_CHUNK = 500  # tag runs applied per idle callback
+
+# Header: magic, version, file mtime (ns), cursor offset, first and last
+# visible character offsets, modified flag
+SESSION_HEADER = struct.Struct('<4sBqIIIB')
+# Tag run: start and end offsets, format flags, size in points, length of the
+# UTF-8 font family name that follows
+SESSION_RUN = struct.Struct('<IIBfH')
+SESSION_LENGTH = struct.Struct('<I')
+
+FORMAT_BOLD = 1
+FORMAT_ITALIC = 2
+FORMAT_UNDERLINE = 4
+
 class RichTextEditor(Gtk.Window):
     def __init__(self):
         Gtk.Window.__init__(self, title="Rich Text Editor")
@@ -108,6 +127,25 @@ class RichTextEditor(Gtk.Window):
         
         # Current file path
         self.current_file = None
+        
+        # Session snapshot state. The body (path, text and tag runs) is cached
+        # so cursor and scroll changes only rewrite the fixed-size header.
+        self.session_dirty = False
+        self.session_text_dirty = False
+        self.session_body = None
+        self.session_body_file = None
+        # Device, inode and size of the snapshot file last written in full
+        self.session_file_id = None
+        self.pending_runs = []
+        self.restore_source_id = None
+        self.restore_modified = False
+        self.textbuffer.connect("changed", self.on_session_text_changed)
+        self.textbuffer.connect("apply-tag", self.on_session_text_changed)
+        self.textbuffer.connect("remove-tag", self.on_session_text_changed)
+        self.textbuffer.connect("mark-set", self.on_session_mark_set)
+        scrolled_window.get_vadjustment().connect("value-changed", self.on_session_changed)
+        self.connect("delete-event", self.on_delete_event)
+        GLib.timeout_add_seconds(SESSION_SAVE_INTERVAL, self.on_session_timer)
 
     def create_menu_bar(self, vbox):
         menubar = Gtk.MenuBar()
@@ -140,7 +178,7 @@ class RichTextEditor(Gtk.Window):
                                    Gtk.AccelFlags.VISIBLE)
         
         quit_item = Gtk.MenuItem(label="Quit")
-        quit_item.connect("activate", Gtk.main_quit)
+        quit_item.connect("activate", self.on_quit)
         quit_item.add_accelerator("activate", self.accel_group, ord('Q'),
                                 Gdk.ModifierType.CONTROL_MASK, Gtk.AccelFlags.VISIBLE)
         
@@ -180,6 +218,8 @@ class RichTextEditor(Gtk.Window):
 
     def on_new(self, widget):
         if self.confirm_save():
+            # Drop any snapshot restore still in progress
+            self.cancel_session_restore()
             # Clear the buffer properly
             self.textbuffer.set_text("")
             # Reset the buffer's modified flag
@@ -228,20 +268,26 @@ class RichTextEditor(Gtk.Window):
         
         response = dialog.run()
         if response == Gtk.ResponseType.OK:
-            self.current_file = dialog.get_filename()
-            try:
-                if self.current_file.lower().endswith('.rtf'):
-                    self.load_rtf_file(self.current_file)
-                else:
-                    # Plain text file
-                    with open(self.current_file, 'r') as file:
-                        self.textbuffer.set_text(file.read())
-                self.set_title(f"Rich Text Editor - {os.path.basename(self.current_file)}")
-            except Exception as e:
-                self.show_error_dialog(f"Error opening file: {str(e)}")
+            self.open_file(dialog.get_filename())
         
         dialog.destroy()
 
+    def open_file(self, filename):
+        self.cancel_session_restore()
+        self.current_file = filename
+        try:
+            if filename.lower().endswith('.rtf'):
+                self.load_rtf_file(filename)
+            else:
+                # Plain text file
+                with open(filename, 'r') as file:
+                    self.textbuffer.set_text(file.read())
+            # The buffer now matches the file on disk
+            self.textbuffer.set_modified(False)
+            self.set_title(f"Rich Text Editor - {os.path.basename(filename)}")
+        except Exception as e:
+            self.show_error_dialog(f"Error opening file: {str(e)}")
+
     def on_save(self, widget):
         if self.current_file:
             self.save_file(self.current_file)
@@ -286,6 +332,7 @@ class RichTextEditor(Gtk.Window):
         dialog.destroy()
 
     def save_file(self, filename):
+        self.finish_session_restore()
         try:
             if filename.lower().endswith('.rtf'):
                 self.save_rtf_file(filename)
@@ -295,9 +342,13 @@ class RichTextEditor(Gtk.Window):
                 text = self.textbuffer.get_text(start, end, False)
                 with open(filename, 'w') as file:
                     file.write(text)
+            self.textbuffer.set_modified(False)
             self.set_title(f"Rich Text Editor - {os.path.basename(filename)}")
         except Exception as e:
             self.show_error_dialog(f"Error saving file: {str(e)}")
+            return
+        # Record the new mtime now, the editor may be killed before it quits
+        self.save_session()
 
     def save_rtf_file(self, filename):
         rtf = "{\\rtf1\\ansi\\deff0"
@@ -472,6 +523,359 @@ class RichTextEditor(Gtk.Window):
                 tag = self.textbuffer.create_tag(None, size_points=format_dict['size'])
                 self.textbuffer.apply_tag(tag, start_iter, end_iter)
 
+    def get_text_format(self, iter):
+        flags = 0
+        size = 0.0
+        family = ''
+        # Tags come in ascending priority, so later tags win
+        for tag in iter.get_tags():
+            if tag.get_property('weight') == Pango.Weight.BOLD:
+                flags |= FORMAT_BOLD
+            if tag.get_property('style') == Pango.Style.ITALIC:
+                flags |= FORMAT_ITALIC
+            if tag.get_property('underline') == Pango.Underline.SINGLE:
+                flags |= FORMAT_UNDERLINE
+            if tag.get_property('size-points'):
+                size = tag.get_property('size-points')
+            if tag.get_property('family'):
+                family = tag.get_property('family')
+        return flags, size, family
+
+    def get_format_tags(self, flags, size, family):
+        # Reuse the same named tags the toolbar creates
+        tag_table = self.textbuffer.get_tag_table()
+        specs = []
+        if flags & FORMAT_BOLD:
+            specs.append(("bold", {'weight': Pango.Weight.BOLD}))
+        if flags & FORMAT_ITALIC:
+            specs.append(("italic", {'style': Pango.Style.ITALIC}))
+        if flags & FORMAT_UNDERLINE:
+            specs.append(("underline", {'underline': Pango.Underline.SINGLE}))
+        if size:
+            specs.append((f"font-size-{size:g}", {'size_points': size}))
+        if family:
+            specs.append((f"font-family-{family}", {'family': family}))
+        
+        tags = []
+        for tag_name, properties in specs:
+            tag = tag_table.lookup(tag_name)
+            if not tag:
+                tag = self.textbuffer.create_tag(tag_name, **properties)
+            tags.append(tag)
+        return tags
+
+    def pack_session_body(self):
+        start, end = self.textbuffer.get_bounds()
+        # get_slice keeps character offsets in line with the buffer
+        text = self.textbuffer.get_slice(start, end, True)
+        
+        # Collapse the tags into runs of identical formatting
+        runs = []
+        iter = start.copy()
+        while iter.compare(end) < 0:
+            run_start = iter.get_offset()
+            text_format = self.get_text_format(iter)
+            iter.forward_to_tag_toggle(None)
+            if text_format == (0, 0.0, ''):
+                continue
+            if runs and runs[-1][1] == run_start and runs[-1][2:] == text_format:
+                runs[-1] = (runs[-1][0], iter.get_offset()) + text_format
+            else:
+                runs.append((run_start, iter.get_offset()) + text_format)
+        
+        path = os.fsencode(self.current_file) if self.current_file else b''
+        data = bytearray()
+        for field in (path, text.encode('utf-8')):
+            data += SESSION_LENGTH.pack(len(field))
+            data += field
+        
+        data += SESSION_LENGTH.pack(len(runs))
+        for run_start, run_end, flags, size, family in runs:
+            family = family.encode('utf-8')
+            data += SESSION_RUN.pack(run_start, run_end, flags, size, len(family))
+            data += family
+        return bytes(data)
+
+    def pack_session_header(self):
+        mtime = 0
+        if self.current_file:
+            try:
+                mtime = os.stat(self.current_file).st_mtime_ns
+            except OSError:
+                pass
+        
+        cursor = self.textbuffer.get_iter_at_mark(self.textbuffer.get_insert())
+        
+        # Remember which lines are on screen so they can be restored first
+        rect = self.textview.get_visible_rect()
+        view_start, _ = self.textview.get_line_at_y(rect.y)
+        view_end, _ = self.textview.get_line_at_y(rect.y + rect.height)
+        if not view_end.ends_line():
+            view_end.forward_to_line_end()
+        
+        return SESSION_HEADER.pack(
+            SESSION_MAGIC, SESSION_VERSION, mtime, cursor.get_offset(),
+            view_start.get_offset(), view_end.get_offset(),
+            self.textbuffer.get_modified())
+
+    def unpack_session(self, data):
+        magic, version, mtime, cursor, view_start, view_end, modified = \
+            SESSION_HEADER.unpack_from(data, 0)
+        if magic != SESSION_MAGIC or version != SESSION_VERSION:
+            raise ValueError("Unrecognised session snapshot")
+        offset = SESSION_HEADER.size
+        
+        def read_bytes(length):
+            nonlocal offset
+            if offset + length > len(data):
+                raise ValueError("Truncated session snapshot")
+            field = data[offset:offset + length]
+            offset += length
+            return field
+        
+        def read_length():
+            return SESSION_LENGTH.unpack(read_bytes(SESSION_LENGTH.size))[0]
+        
+        path = read_bytes(read_length())
+        text = read_bytes(read_length()).decode('utf-8')
+        runs = []
+        for _ in range(read_length()):
+            run_start, run_end, flags, size, family_length = \
+                SESSION_RUN.unpack(read_bytes(SESSION_RUN.size))
+            family = read_bytes(family_length).decode('utf-8')
+            runs.append((run_start, run_end, flags, size, family))
+        
+        return {
+            'path': os.fsdecode(path) if path else None,
+            'mtime': mtime,
+            'cursor': cursor,
+            'view': (view_start, view_end),
+            'modified': bool(modified),
+            'text': text,
+            'runs': runs,
+        }
+
+    def save_session(self):
+        # A half-restored buffer is missing tags, keep the previous snapshot
+        if self.restore_source_id:
+            return
+        if (self.session_text_dirty or self.session_body is None
+                or self.session_body_file != self.current_file):
+            self.session_body = self.pack_session_body()
+            self.session_body_file = self.current_file
+            self.session_text_dirty = False
+            self.session_file_id = None
+        header = self.pack_session_header()
+        try:
+            # Only the cursor, view, mtime or modified flag moved
+            if not self.patch_session_header(header):
+                self.write_session_file(header, self.session_body)
+        except OSError:
+            # The snapshot is best effort, it must not interrupt editing.
+            # Rewrite it in full next time in case the file went missing.
+            self.session_file_id = None
+            return
+        self.session_dirty = False
+
+    def get_session_file_id(self, fd):
+        stat = os.fstat(fd)
+        return stat.st_dev, stat.st_ino, stat.st_size
+
+    def patch_session_header(self, header):
+        if self.session_file_id is None:
+            return False
+        with open(SESSION_FILE, 'r+b') as file:
+            # Another editor may have replaced the snapshot since our last full
+            # write, its body must not be paired with our header
+            if self.get_session_file_id(file.fileno()) != self.session_file_id:
+                return False
+            file.write(header)
+            file.flush()
+            os.fsync(file.fileno())
+        return True
+
+    def write_session_file(self, header, body):
+        os.makedirs(os.path.dirname(SESSION_FILE), mode=0o700, exist_ok=True)
+        # Write and sync a temporary file, then swap it in, so a crash or power
+        # loss leaves either the old snapshot or the new one. The snapshot holds
+        # unsaved text, so only the owner may read it.
+        temp_file = f"{SESSION_FILE}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as file:
+                file.write(header)
+                file.write(body)
+                file.flush()
+                os.fsync(file.fileno())
+                file_id = self.get_session_file_id(file.fileno())
+            os.replace(temp_file, SESSION_FILE)
+            self.session_file_id = file_id
+        except OSError:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+            raise
+
+    def restore_session(self):
+        try:
+            with open(SESSION_FILE, 'rb') as file:
+                data = file.read()
+                file_id = self.get_session_file_id(file.fileno())
+            session = self.unpack_session(data)
+        except (OSError, ValueError, struct.error):
+            # No usable snapshot, start with an empty document
+            return
+        
+        path = session['path']
+        if path:
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != session['mtime']:
+                if session['modified'] and self.confirm_restore_unsaved(path, mtime is None):
+                    # Keep the unsaved text, it stays modified until saved again
+                    pass
+                elif mtime is not None:
+                    # The file changed since the snapshot, parse it again
+                    self.open_file(path)
+                    return
+                else:
+                    return
+        
+        self.cancel_session_restore()
+        self.current_file = path
+        self.textbuffer.set_text(session['text'])
+        
+        # Format the lines that were on screen now, the rest when idle
+        view_start, view_end = session['view']
+        visible_runs = []
+        hidden_runs = []
+        for run in session['runs']:
+            if run[0] < view_end and run[1] > view_start:
+                visible_runs.append(run)
+            else:
+                hidden_runs.append(run)
+        self.apply_session_runs(visible_runs)
+        
+        self.textbuffer.place_cursor(self.textbuffer.get_iter_at_offset(session['cursor']))
+        view_iter = self.textbuffer.get_iter_at_offset(view_start)
+        view_mark = self.textbuffer.get_mark("session-view")
+        if view_mark:
+            self.textbuffer.move_mark(view_mark, view_iter)
+        else:
+            view_mark = self.textbuffer.create_mark("session-view", view_iter, True)
+        # Scrolling to a mark waits for the layout, unlike setting the adjustment
+        self.textview.scroll_to_mark(view_mark, 0.0, True, 0.0, 0.0)
+        
+        if path:
+            self.set_title(f"Rich Text Editor - {os.path.basename(path)}")
+        
+        self.restore_modified = session['modified']
+        self.textbuffer.set_modified(self.restore_modified)
+        if hidden_runs:
+            # Offsets would go stale if the text changed under the pending runs
+            self.textview.set_editable(False)
+            # Stored reversed so each chunk can be taken off the end cheaply
+            self.pending_runs = hidden_runs[::-1]
+            self.restore_source_id = GLib.idle_add(
+                self.on_session_restore_idle, priority=GLib.PRIORITY_LOW)
+        
+        # The buffer matches the snapshot body already on disk
+        self.session_body = data[SESSION_HEADER.size:]
+        self.session_body_file = path
+        self.session_file_id = file_id
+        self.session_text_dirty = False
+        self.session_dirty = False
+
+    def confirm_restore_unsaved(self, path, missing):
+        dialog = Gtk.MessageDialog(
+            parent=self,
+            flags=0,
+            message_type=Gtk.MessageType.QUESTION,
+            buttons=Gtk.ButtonsType.YES_NO,
+            text="Restore unsaved changes?")
+        if missing:
+            reason = "was moved or deleted"
+        else:
+            reason = "has changed on disk"
+        dialog.format_secondary_text(
+            f"{os.path.basename(path)} {reason} since your last session. "
+            "Choose Yes to keep the unsaved changes instead of the file on disk.")
+        response = dialog.run()
+        dialog.destroy()
+        
+        # Only an explicit Yes puts the older snapshot over the file on disk
+        return response == Gtk.ResponseType.YES
+
+    def apply_session_runs(self, runs):
+        for run_start, run_end, flags, size, family in runs:
+            start_iter = self.textbuffer.get_iter_at_offset(run_start)
+            end_iter = self.textbuffer.get_iter_at_offset(run_end)
+            for tag in self.get_format_tags(flags, size, family):
+                self.textbuffer.apply_tag(tag, start_iter, end_iter)
+
+    def cancel_session_restore(self):
+        if self.restore_source_id:
+            GLib.source_remove(self.restore_source_id)
+            self.restore_source_id = None
+            self.textview.set_editable(True)
+        self.pending_runs = []
+
+    def finish_session_restore(self):
+        # Apply every pending run now, before anything reads or edits the buffer
+        if not self.restore_source_id:
+            return
+        GLib.source_remove(self.restore_source_id)
+        self.apply_session_runs(reversed(self.pending_runs))
+        self.pending_runs = []
+        self.end_session_restore()
+
+    def end_session_restore(self):
+        self.restore_source_id = None
+        self.textview.set_editable(True)
+        self.textbuffer.set_modified(self.restore_modified)
+        self.session_text_dirty = False
+        self.session_dirty = False
+
+    def on_session_restore_idle(self):
+        chunk = self.pending_runs[-SESSION_RESTORE_CHUNK:]
+        del self.pending_runs[-SESSION_RESTORE_CHUNK:]
+        self.apply_session_runs(reversed(chunk))
+        if self.pending_runs:
+            return True
+        
+        self.end_session_restore()
+        return False
+
+    def on_session_text_changed(self, *args):
+        self.session_text_dirty = True
+        self.session_dirty = True
+
+    def on_session_changed(self, *args):
+        self.session_dirty = True
+
+    def on_session_mark_set(self, buffer, location, mark):
+        if mark == self.textbuffer.get_insert():
+            self.session_dirty = True
+
+    def on_session_timer(self):
+        if self.session_dirty:
+            self.save_session()
+        return True
+
+    def on_delete_event(self, widget, event):
+        # save_session skips a half-restored buffer, so finish it first
+        self.finish_session_restore()
+        self.save_session()
+        return False
+
+    def on_quit(self, widget):
+        self.finish_session_restore()
+        self.save_session()
+        Gtk.main_quit()
+
     def confirm_save(self):
         if self.textbuffer.get_modified():
             dialog = Gtk.MessageDialog(
@@ -505,6 +909,8 @@ class RichTextEditor(Gtk.Window):
         dialog.destroy()
 
     def on_cut(self, widget):
+        # Cut and paste edit the buffer directly, bypassing the read-only view
+        self.finish_session_restore()
         clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
         self.textbuffer.cut_clipboard(clipboard, True)
 
@@ -513,6 +919,7 @@ class RichTextEditor(Gtk.Window):
         self.textbuffer.copy_clipboard(clipboard)
 
     def on_paste(self, widget):
+        self.finish_session_restore()
         clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
         self.textbuffer.paste_clipboard(clipboard, None, True)
 
@@ -525,6 +932,8 @@ class RichTextEditor(Gtk.Window):
         self.apply_font_size(size)
 
     def apply_font_size(self, size):
+        # Formatting must not be overwritten by the pending snapshot runs
+        self.finish_session_restore()
         bounds = self.textbuffer.get_selection_bounds()
         if not bounds:
             return
@@ -575,6 +984,7 @@ class RichTextEditor(Gtk.Window):
                 break
 
     def on_font_family_changed(self, combo):
+        self.finish_session_restore()
         bounds = self.textbuffer.get_selection_bounds()
         if not bounds:
             return
@@ -612,6 +1022,7 @@ class RichTextEditor(Gtk.Window):
         context.add_provider(css_provider, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION)
 
     def on_format_button_toggled(self, button, format_type):
+        self.finish_session_restore()
         bounds = self.textbuffer.get_selection_bounds()
         if not bounds:
             # If no selection, create a mark at cursor position for formatting
@@ -656,6 +1067,7 @@ def main():
     win = RichTextEditor()
     win.connect("destroy", Gtk.main_quit)
     win.show_all()
+    win.restore_session()
     Gtk.main()
 
 if __name__ == "__main__":